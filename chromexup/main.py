@@ -6,16 +6,18 @@ External extension updater for Chromium based browsers.
 
 import argparse
 import configparser
-import glob
 import json
 import logging
 import os
-import re
 import sys
-from multiprocessing.dummy import Pool as ThreadPool
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from typing import Any, Dict, List, Tuple
+from urllib.parse import urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
 import chromexup
@@ -23,12 +25,27 @@ import chromexup
 if sys.platform.startswith('win32'):
     import winreg
 
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+    _json_loads = json.loads
+
 logger = logging.getLogger(__name__)
 
 # Settings
 WEBSTORE_URL_TPL = 'https://clients2.google.com/service/update2/crx?' \
                    'response=redirect&prodversion=199&acceptformat=crx2,crx3&' \
                    'x=id%3D{}%26installsource%3Dondemand%26uc'
+PREF_TPL = '{{"external_crx": "{}", "external_version": "{}"}}'
+WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_CLOEXEC', 0) | \
+    getattr(os, 'O_BINARY', 0)
 LOGGING_FORMAT = '[%(levelname)s] %(message)s'
 
 if sys.platform.startswith('win32'):
@@ -36,6 +53,9 @@ if sys.platform.startswith('win32'):
     EXT_KEY = 'Software\\Google\\Chrome\\Extensions'
 
 cfg: Dict[str, Any] = None
+_http: requests.Session = None
+_host_sem: threading.BoundedSemaphore = None
+_thread_sem: threading.BoundedSemaphore = None
 
 
 def process(id: str) -> None:
@@ -44,19 +64,30 @@ def process(id: str) -> None:
     :param id: Extension ID
     :return:
     """
-    installed_ver = _get_installed_version(id)
+    # Limit the shared thread pool to the thread count of the current configuration
+    with _thread_sem:
+        _process(id)
+
+
+def _process(id: str) -> None:
+    """
+    Checks if an extension is outdated and updates it if necessary, without limiting concurrency.
+    :param id: Extension ID
+    :return:
+    """
     try:
         (latest_ver, url) = _get_latest_version(id)
     except FileNotFoundError:
         return
 
+    installed_ver = _get_installed_version(id)
     is_outdated = installed_ver != latest_ver
     logger.debug('id: %s, installed_ver: %s, latest_ver: %s, is_outdated: %s', id,
                  installed_ver, latest_ver, is_outdated)
     if is_outdated:
         logger.info('updating %s', id)
-        ext_data = _download(url)
-        _create(id, latest_ver, ext_data)
+        _download(url, os.path.join(cfg['extdir'], '%s.crx' % id))
+        _create(id, latest_ver)
 
 
 def _get_installed_version(id: str) -> str:
@@ -65,24 +96,22 @@ def _get_installed_version(id: str) -> str:
     :param id: Extension ID
     :return: Extension version
     """
-    if sys.platform.startswith('linux') or sys.platform.startswith('darwin'):
-        try:
-            # Get version from preferences file
-            with open(os.path.join(cfg['extdir'], '%s.json' % id), 'r') as f:
-                pref_data = json.load(f)
-                if 'external_version' not in pref_data:
-                    raise KeyError
-                return pref_data['external_version']
-        except FileNotFoundError:
-            return '0'
-    elif sys.platform.startswith('win32'):
-        try:
-            # Get version from registry value
-            with winreg.OpenKey(HKEY_ROOT, EXT_KEY + '\\' + id) as key:
-                version = winreg.QueryValueEx(key, 'version')[0]
-                return version
-        except FileNotFoundError:
-            return '0'
+    # Get version from the preloaded preferences files or registry values
+    return cfg['_state'].get(id, '0')
+
+
+def _create_session(pool_size: int) -> requests.Session:
+    """
+    Creates the HTTP session shared by all threads.
+    Its connection pool keeps connections alive and hands them to whichever thread needs one.
+    :param pool_size: Maximum number of connections kept per host
+    :return: HTTP session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
 
 
 def _get_latest_version(id: str) -> Tuple[str, str]:
@@ -91,9 +120,15 @@ def _get_latest_version(id: str) -> Tuple[str, str]:
     :param id: Extension ID
     :return: Tuple of the extension version and the download URL
     """
-    # Request URL but do not follow the redirection and do not download the extension
+    # Request URL but do not follow the redirection and do not download the extension.
+    # A HEAD request yields the same redirection without a response body, fall back to GET
+    # if the server does not answer it with a redirection.
+    url = WEBSTORE_URL_TPL.format(id)
     try:
-        r = requests.get(url=WEBSTORE_URL_TPL.format(id), allow_redirects=False)
+        with _host_sem:
+            r = _http.head(url=url, allow_redirects=False)
+            if r.status_code != 204 and not r.is_redirect:
+                r = _http.get(url=url, allow_redirects=False)
     except RequestException as e:
         logger.error('failed URL request for extension %s', id)
         logger.debug(e)
@@ -106,57 +141,110 @@ def _get_latest_version(id: str) -> Tuple[str, str]:
 
     # Extract the version from the download URL
     url = r.next.url
-    m = re.search(r'/[A-Z]+_([\d_]+).crx', url)
-    if not m:
+    # The file name has the form <NAME>_<version>.crx, with underscores separating the version
+    # components
+    path = urlsplit(url).path
+    name = path[path.rfind('/') + 1:]
+    prefix, _, version = name[:-4].partition('_')
+    if not name.endswith('.crx') or not prefix.isalpha() or not version.replace('_', '').isdigit():
         logger.error('extension version not found')
         logger.debug(url)
         raise RuntimeError
-    version = m.group(1).replace('_', '.')
+    version = version.replace('_', '.')
 
     return version, url
 
 
-def _download(url: str) -> bytearray:
+def _download(url: str, path: str) -> None:
     """
-    Downloads an extension and returns its contents.
+    Downloads an extension and streams its contents to a file.
+    The contents are written to a temporary file first, which replaces the target file once the
+    download is complete.
     :param url: Download URL
-    :return: Extension contents
+    :param path: Extension file path
+    :return:
     """
+    tmp_path = path + '.tmp'
     try:
-        r = requests.get(url=url)
+        with _host_sem, _http.get(url=url, stream=True) as r, open(tmp_path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=64 * 1024):
+                f.write(chunk)
+        os.replace(tmp_path, path)
     except RequestException as e:
         logger.error('download failed')
         logger.debug(e)
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
         os._exit(1)
-
-    return r.content
+    except OSError:
+        # Do not leave a partial download behind
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
 
 
-def _create(id: str, version: str, data: bytearray) -> None:
+def _write_file(path: str, data: bytes) -> None:
     """
-    Creates an extension and the accompanying preferences file in the same directory.
+    Writes data to a temporary file which then atomically replaces the target file.
+    :param path: File path
+    :param data: File contents
+    :return:
+    """
+    tmp_path = path + '.tmp'
+    fd = os.open(tmp_path, WRITE_FLAGS, 0o644)
+    try:
+        try:
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, path)
+    except OSError:
+        # Do not leave a partial file behind
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+        raise
+
+
+def _create_posix(id: str, version: str) -> None:
+    """
+    Creates the preferences file accompanying a downloaded extension in the same directory.
     The preferences file contains a path to the .crx file and a version string.
     :param id: Extension ID
     :param version: Extension version
-    :param data: Extension byte array
     :return:
     """
-    # Create extension
     ext_name = '%s.crx' % id
-    with open(os.path.join(cfg['extdir'], ext_name), 'wb') as f:
-        f.write(data)
+    pref_name = '%s.json' % id
+    values = ext_name + version
+    if values.isprintable() and '"' not in values and '\\' not in values:
+        # Nothing to escape, fill in the template
+        pref_data = PREF_TPL.format(ext_name, version).encode()
+    else:
+        pref_data = _json_dumps({'external_crx': ext_name, 'external_version': version})
+    _write_file(os.path.join(cfg['extdir'], pref_name), pref_data)
+
+
+def _create_win32(id: str, version: str) -> None:
+    """
+    Creates the registry key accompanying a downloaded extension.
+    The registry key contains a path to the .crx file and a version string.
+    :param id: Extension ID
+    :param version: Extension version
+    :return:
+    """
+    ext_name = '%s.crx' % id
+    with winreg.CreateKey(winreg.HKEY_CURRENT_USER, EXT_KEY + '\\' + id) as key:
+        winreg.SetValueEx(key, 'path', 0, winreg.REG_SZ, os.path.join(cfg['extdir'], ext_name))
+        winreg.SetValueEx(key, 'version', 0, winreg.REG_SZ, version)
 
-    if sys.platform.startswith('linux') or sys.platform.startswith('darwin'):
-        # Create preferences file
-        pref_name = '%s.json' % id
-        pref_data = {'external_crx': ext_name, 'external_version': version}
-        with open(os.path.join(cfg['extdir'], pref_name), 'w') as f:
-            json.dump(pref_data, f)
-    elif sys.platform.startswith('win32'):
-        # Create registry key
-        with winreg.CreateKey(winreg.HKEY_CURRENT_USER, EXT_KEY + '\\' + id) as key:
-            winreg.SetValueEx(key, 'path', 0, winreg.REG_SZ, os.path.join(cfg['extdir'], ext_name))
-            winreg.SetValueEx(key, 'version', 0, winreg.REG_SZ, version)
+
+# Bind the platform specific implementation once, the platform does not change at runtime
+if sys.platform.startswith('win32'):
+    _create = _create_win32
+else:
+    _create = _create_posix
 
 
 def _config_dir() -> str:
@@ -219,6 +307,49 @@ def check(cfgfile: str, ext_dir: str) -> None:
         os.mkdir(ext_dir, 0o755)
 
 
+def _load_state() -> None:
+    """
+    Scans the extension directory once and caches the installed extensions and the versions
+    found in their preferences files, or in the registry on Windows.
+    :return:
+    """
+    state = {}
+    crx_files = set()
+    extensions = set(cfg['extensions'])
+    read_prefs = sys.platform.startswith('linux') or sys.platform.startswith('darwin')
+    with os.scandir(cfg['extdir']) as it:
+        for e in it:
+            id, ext = os.path.splitext(e.name)
+            if ext == '.crx':
+                crx_files.add(id)
+            elif ext == '.json' and read_prefs and id in extensions:
+                # Only the versions of configured extensions are needed, orphans are removed by
+                # their .crx file
+                with open(e.path, 'rb') as f:
+                    pref_data = _json_loads(f.read())
+                if 'external_version' not in pref_data:
+                    logger.warning('missing version in preferences file %s', e.path)
+                    continue
+                state[id] = pref_data['external_version']
+
+    if sys.platform.startswith('win32'):
+        # Enumerate the extension registry keys once
+        with suppress(FileNotFoundError), winreg.OpenKey(HKEY_ROOT, EXT_KEY) as key:
+            i = 0
+            while True:
+                try:
+                    id = winreg.EnumKey(key, i)
+                except OSError:
+                    # No more subkeys
+                    break
+                i += 1
+                with suppress(FileNotFoundError), winreg.OpenKey(key, id) as subkey:
+                    state[id] = winreg.QueryValueEx(subkey, 'version')[0]
+
+    cfg['_state'] = state
+    cfg['_crx_files'] = crx_files
+
+
 def remove_orphans() -> None:
     """
     Removes extensions and their accompanying preference files not defined in the configuration
@@ -230,32 +361,69 @@ def remove_orphans() -> None:
         return
 
     # Get IDs of orphaned extensions
-    ext_files = glob.glob(os.path.join(cfg['extdir'], '*.crx'))
-    ext_files = [os.path.splitext(os.path.basename(e))[0] for e in ext_files]
-    orphans = list(set(ext_files) - set(cfg['extensions']))
+    orphans = list(cfg['_crx_files'] - set(cfg['extensions']))
     if not orphans:
         return
 
     logger.info('removing orphans: %s', orphans)
 
+    # Remove orphaned extensions
+    extdir = cfg['extdir']
+    suffixes = ('.crx',)
     if sys.platform.startswith('linux') or sys.platform.startswith('darwin'):
-        for id in orphans:
-            try:
-                # Remove orphaned extension and preferences file
-                os.remove(os.path.join(cfg['extdir'], '%s.crx' % id))
-                os.remove(os.path.join(cfg['extdir'], '%s.json' % id))
-            except FileNotFoundError as e:
-                logger.error('file not found while removing extension %s', id)
-                logger.debug(e)
-    elif sys.platform.startswith('win32'):
-        for id in orphans:
-            try:
-                # Remove orphaned extension and registry keys
-                os.remove(os.path.join(cfg['extdir'], '%s.crx' % id))
-                winreg.DeleteKey(HKEY_ROOT, EXT_KEY + '\\' + id)
-            except FileNotFoundError as e:
-                logger.error('file not found while removing extension %s', id)
-                logger.debug(e)
+        # Remove preferences files as well
+        suffixes += ('.json',)
+    for id in orphans:
+        for suffix in suffixes:
+            with suppress(FileNotFoundError):
+                os.unlink(os.path.join(extdir, id + suffix))
+
+    if sys.platform.startswith('win32'):
+        # Remove registry keys
+        with suppress(FileNotFoundError), \
+                winreg.OpenKey(HKEY_ROOT, EXT_KEY, 0, winreg.KEY_WRITE) as key:
+            for id in orphans:
+                with suppress(FileNotFoundError):
+                    winreg.DeleteKey(key, id)
+
+
+def _read_toml(cfgfile: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Reads a TOML configuration file.
+    :param cfgfile: Configuration file path
+    :return: Dictionary of the sections and their options
+    """
+    try:
+        with open(cfgfile, 'rb') as f:
+            return tomllib.load(f)
+    except tomllib.TOMLDecodeError as e:
+        logger.error('invalid configuration file %s', cfgfile)
+        logger.debug(e)
+        exit(1)
+
+
+def _read_ini(cfgfile: str) -> Dict[str, Dict[str, Any]]:
+    """
+    Reads a legacy INI configuration file.
+    :param cfgfile: Configuration file path
+    :return: Dictionary of the sections and their options
+    """
+    logger.warning('INI configuration files are deprecated, please convert %s to TOML and remove '
+                   'it', cfgfile)
+
+    parser = configparser.ConfigParser()
+    parser.read(cfgfile)
+
+    data = {s: dict(parser[s]) for s in parser.sections()}
+    if 'main' in data:
+        # Convert the values of typed options
+        main = parser['main']
+        for key in ('threads', 'max_host_concurrency'):
+            if key in main:
+                data['main'][key] = main.getint(key)
+        if 'remove_orphans' in main:
+            data['main']['remove_orphans'] = main.getboolean('remove_orphans')
+    return data
 
 
 def parse_config(cfgfile: str) -> Dict[str, Any]:
@@ -266,23 +434,53 @@ def parse_config(cfgfile: str) -> Dict[str, Any]:
     """
 
     sections = ['main', 'extensions']
-    parser = configparser.ConfigParser()
-    parser.read(cfgfile)
+    if os.path.splitext(cfgfile)[1] == '.toml':
+        data = _read_toml(cfgfile)
+    else:
+        data = _read_ini(cfgfile)
 
     # Quick section check
     for s in sections:
-        if s not in parser:
+        if s not in data:
             logger.error('missing section in configuration file: [%s]', s)
             exit(1)
+        if not isinstance(data[s], dict):
+            logger.error('invalid configuration file %s: [%s] must be a table', cfgfile, s)
+            exit(1)
 
+    main = data['main']
     cfg = {
         # Main section
-        'branding': parser['main'].get('branding', 'chromium'),
-        'threads': parser['main'].getint('threads', 4),
-        'remove_orphans': parser['main'].getboolean('remove_orphans', False),
+        'branding': main.get('branding', 'chromium'),
+        'threads': main.get('threads', 4),
+        'max_host_concurrency': main.get('max_host_concurrency', 6),
+        'remove_orphans': main.get('remove_orphans', False),
         # Extensions section
-        'extensions': [e for e in parser['extensions'].values()]
+        'extensions': [e for e in data['extensions'].values()]
     }
+
+    # Check value types, TOML values are not converted like INI values
+    types = {'branding': str, 'threads': int, 'max_host_concurrency': int, 'remove_orphans': bool}
+    for key, t in types.items():
+        if not isinstance(cfg[key], t) or (t is int and isinstance(cfg[key], bool)):
+            logger.error('invalid configuration file %s: %s must be of type %s', cfgfile, key,
+                         t.__name__)
+            exit(1)
+    for e in cfg['extensions']:
+        if not isinstance(e, str):
+            logger.error('invalid configuration file %s: extension ID %r must be of type str',
+                         cfgfile, e)
+            exit(1)
+    # Process every extension once, duplicate IDs would write to the same files concurrently
+    cfg['extensions'] = list(dict.fromkeys(cfg['extensions']))
+
+    # Check value ranges
+    for key in ('threads', 'max_host_concurrency'):
+        if cfg[key] < 1:
+            logger.error('invalid value in configuration file: %s = %s, must be at least 1', key,
+                         cfg[key])
+            exit(1)
+
     # Set extension directory
     cfg['extdir'] = _extensions_dir(cfg['branding'])
 
@@ -309,7 +507,22 @@ def parse_args() -> argparse.Namespace:
 
 
 def get_cfgfiles() -> List[str]:
-    result = glob.glob(os.path.join(_config_dir(), '*.ini'))
+    cfgdir = _config_dir()
+    result = []
+    if os.path.isdir(cfgdir):
+        with os.scandir(cfgdir) as it:
+            result = [e.path for e in it
+                      if e.name.endswith(('.toml', '.ini')) and not e.name.startswith('.')
+                      and e.is_file()]
+
+    # Skip legacy INI files which have already been converted to TOML
+    toml_files = {os.path.splitext(f)[0] for f in result if f.endswith('.toml')}
+    for f in [f for f in result if f.endswith('.ini')]:
+        if os.path.splitext(f)[0] in toml_files:
+            logger.warning('skipping %s, superseded by %s.toml, please remove it', f,
+                           os.path.splitext(f)[0])
+            result.remove(f)
+
     logger.debug('found %d configuration file(s): %s', len(result), result)
     return result
 
@@ -319,7 +532,7 @@ def main() -> None:
     Main method.
     :return:
     """
-    global cfg
+    global cfg, _host_sem, _thread_sem, _http
 
     # Parse command line arguments
     args = parse_args()
@@ -327,24 +540,34 @@ def main() -> None:
     # Initialize logging
     logging.basicConfig(format=LOGGING_FORMAT, level=args.loglevel)
 
-    # Parse all configuration files
+    # Parse all configuration files up front to size the shared thread pool and connection pool,
+    # an invalid file stops the run before any configuration is processed
     cfgfiles = get_cfgfiles()
-    for cfgfile in cfgfiles:
-        cfg = parse_config(cfgfile)
-
-        # Check configuration
-        check(cfgfile, cfg['extdir'])
-
-        # Process extensions
-        extensions = cfg['extensions']
-        logger.info('%s, processing %d extension(s)', os.path.basename(cfgfile), len(extensions))
-        pool = ThreadPool(cfg['threads'])
-        pool.map(process, extensions)
-        pool.close()
-        pool.join()
-
-        # Remove orphans
-        remove_orphans()
+    cfgs = [parse_config(cfgfile) for cfgfile in cfgfiles]
+    if not cfgs:
+        return
+
+    # Share the connection pool and the worker threads across all configurations
+    _http = _create_session(max(c['max_host_concurrency'] for c in cfgs))
+    max_threads = max(min(c['threads'], len(c['extensions'])) for c in cfgs)
+    with ThreadPoolExecutor(max_workers=max(max_threads, 1)) as executor:
+        for cfgfile, c in zip(cfgfiles, cfgs):
+            cfg = c
+
+            # Check configuration
+            check(cfgfile, cfg['extdir'])
+            _load_state()
+            _host_sem = threading.BoundedSemaphore(cfg['max_host_concurrency'])
+            _thread_sem = threading.BoundedSemaphore(cfg['threads'])
+
+            # Process extensions
+            extensions = cfg['extensions']
+            logger.info('%s, processing %d extension(s)', os.path.basename(cfgfile),
+                        len(extensions))
+            list(executor.map(process, extensions))
+
+            # Remove orphans
+            remove_orphans()
 
 
 if __name__ == '__main__':
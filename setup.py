@@ -27,7 +27,10 @@ setup(
     ],
     keywords='browser chrome chromium external extension updater',
     packages=find_packages(),
-    install_requires=['requests'],
+    install_requires=['requests', 'tomli; python_version < "3.11"'],
+    extras_require={
+        'orjson': ['orjson']
+    },
     entry_points={
         'console_scripts': ['chromexup = chromexup.main:main']
     },